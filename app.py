@@ -1,7 +1,7 @@
 from exporter import create_app
 from exporter.config import Config
 
-app = create_app(Config())
+app = create_app(Config.from_env())
 
 if __name__ == "__main__":
     app.run()
@@ -1,6 +1,8 @@
 from flask import Flask
+from flask_compress import Compress
 from werkzeug.exceptions import HTTPException
 
+from .auth import get_credentials_digests
 from .config import Config
 from .errors import handle_http_exceptions
 from .controllers import export_bp
@@ -9,10 +11,27 @@ from .controllers import export_bp
 def create_app(config_object: Config) -> Flask:
     app = Flask("converter", instance_relative_config=True)
     app.config.from_object(config_object)
+    app.config.update(
+        COMPRESS_MIMETYPES=["application/json", "application/xml"],
+        COMPRESS_MIN_SIZE=500,
+    )
+    _precompute_config(app)
+    Compress(app)
     app.register_error_handler(HTTPException, handle_http_exceptions)
     _register_routes(app)
     return app
 
 
+def _precompute_config(app: Flask) -> None:
+    """
+    Derives config values once, instead of on every request.
+    """
+    app.config["ROSSUM_AUTH_HEADER"] = f"token {app.config['ROSSUM_TOKEN']}"
+    app.config["ROSSUM_QUEUES_URL"] = f"{app.config['BASE_ROSSUM_URL'].rstrip('/')}/v1/queues/"
+    app.config["CORRECT_CREDENTIALS_DIGESTS"] = get_credentials_digests(
+        app.config["CORRECT_USERNAME"], app.config["CORRECT_PASSWORD"]
+    )
+
+
 def _register_routes(app: Flask) -> None:
     app.register_blueprint(export_bp)
@@ -1,4 +1,7 @@
 import functools
+import hashlib
+import hmac
+from typing import Optional
 
 from flask import abort, current_app, request
 
@@ -23,20 +26,41 @@ def correct_auth_required(view):
     return wrapped_view
 
 
+def get_credentials_digests(username: str, password: str) -> Optional[tuple[bytes, bytes]]:
+    """
+    Hashes credentials, so that they can be compared in constant time.
+    :param username: str
+    :param password: str
+    :return: tuple of username and password digests,
+        None if any of credentials is missing.
+    """
+    if not username or not password:
+        return None
+    return _get_digest(username), _get_digest(password)
+
+
 def _credentials_are_correct(username: str, password: str) -> bool:
     """
     Compares provided credentials with the only one correct,
-    stored in the config of the app.
+    digests of which are stored in the config of the app.
     :param username: str, provided by user.
     :param password: str, provided by user.
     :return: bool, whether provided and correct credentials match.
     """
-    correct_username = current_app.config["CORRECT_USERNAME"]
-    correct_password = current_app.config["CORRECT_PASSWORD"]
+    correct_digests = current_app.config["CORRECT_CREDENTIALS_DIGESTS"]
 
     # If any of correct credentials are missing, raise server error,
     # so that it is explicit that an error is on our side
-    if not correct_username or not correct_password:
+    if correct_digests is None:
         raise abort(500, "Cannot check credential correctness.")
 
-    return username == correct_username and password == correct_password
+    correct_username_digest, correct_password_digest = correct_digests
+    # Bitwise "&", so that the password is compared even if the username is wrong
+    return (
+        hmac.compare_digest(_get_digest(username), correct_username_digest)
+        & hmac.compare_digest(_get_digest(password), correct_password_digest)
+    )
+
+
+def _get_digest(value: str) -> bytes:
+    return hashlib.sha256(value.encode()).digest()
@@ -1,18 +1,28 @@
-from flask import Blueprint, jsonify, Response
-from pydantic import BaseModel
+from typing import Any
+
+from flask import Blueprint, Response
+from pydantic import BaseModel, conlist
 
 from exporter.auth import correct_auth_required
 from exporter.decorators import validate_data
-from exporter.services import send_annotation_info
+from exporter.responses import json_response
+from exporter.services import send_annotation_info, send_annotations_info
 
 export_bp = Blueprint("export", __name__)
 
+# Whole batch is processed within one request, so it is kept reasonably small
+MAX_BATCH_SIZE = 100
+
 
 class ExportBody(BaseModel):
     annotation_id: int
     queue_id: int
 
 
+class ExportBatchBody(BaseModel):
+    __root__: conlist(ExportBody, max_items=MAX_BATCH_SIZE)
+
+
 @export_bp.post("/export")
 @correct_auth_required
 @validate_data(ExportBody)
@@ -25,7 +35,31 @@ def export_view(body: ExportBody) -> Response:
         "error" with corresponding error message if any error occurred.
     """
     success, error_message = send_annotation_info(body.queue_id, body.annotation_id)
-    response = {"success": success}
+    return json_response(_get_export_result(success, error_message))
+
+
+@export_bp.post("/export/batch")
+@correct_auth_required
+@validate_data(ExportBatchBody)
+def export_batch_view(body: ExportBatchBody) -> Response:
+    """
+    Same as export_view, but for a list of annotations, which are exported concurrently.
+    :param body: ExportBatchBody, list of objects with annotation_id and queue_id.
+    :return: json Response. List of export_view results in the order of the body,
+        each one also contains its "annotation_id".
+    """
+    exports = body.__root__
+    results = send_annotations_info([
+        (export.queue_id, export.annotation_id) for export in exports
+    ])
+    return json_response([
+        {"annotation_id": export.annotation_id, **_get_export_result(success, error_message)}
+        for export, (success, error_message) in zip(exports, results)
+    ])
+
+
+def _get_export_result(success: bool, error_message: str) -> dict[str, Any]:
+    result = {"success": success}
     if error_message:
-        response["error_message"] = error_message
-    return jsonify(response)
+        result["error_message"] = error_message
+    return result
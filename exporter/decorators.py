@@ -1,8 +1,14 @@
 from functools import wraps
 from typing import Callable, Type, get_type_hints
 
-from flask import jsonify, request
+import orjson
+from flask import request
 from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import DictError
+from pydantic.utils import ROOT_KEY
+
+from exporter.responses import json_response
 
 
 def validate_data(model: Type[BaseModel]) -> Callable:
@@ -11,17 +17,34 @@ def validate_data(model: Type[BaseModel]) -> Callable:
 
         @wraps(view)
         def wrapped_view(*args, **kwargs):
-            data = request.get_json(force=True)
             try:
-                validated_data = model(**data)
+                validated_data = _parse_body(model, request.get_data(cache=False))
                 kwargs[model_arg_name] = validated_data
                 return view(*args, **kwargs)
             except ValidationError as e:
-                return jsonify(e.errors()), 400
+                return json_response(e.errors()), 400
         return wrapped_view
     return wrapper
 
 
+def _parse_body(model: Type[BaseModel], body: bytes) -> BaseModel:
+    """
+    Parses a json body into the model.
+    Unless the model has a custom root, the body must be a json object:
+    pydantic alone would accept anything dict() can convert, e.g. a list of pairs.
+    :param model: pydantic model to parse the body into
+    :param body: raw json body
+    :return: instance of the model
+    """
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise ValidationError([ErrorWrapper(e, loc=ROOT_KEY)], model)
+    if not model.__custom_root_type__ and not isinstance(data, dict):
+        raise ValidationError([ErrorWrapper(DictError(), loc=ROOT_KEY)], model)
+    return model.parse_obj(data)
+
+
 def _get_model_arg_name(view: Callable) -> str:
     for arg_name, arg_type in get_type_hints(view).items():
         if issubclass(arg_type, BaseModel):
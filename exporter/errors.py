@@ -1,8 +1,22 @@
-from flask import jsonify, Response
+import logging
+from http import HTTPStatus
+
+from flask import Response
 from werkzeug.exceptions import HTTPException
 
+from exporter.responses import json_response
+
 
 def handle_http_exceptions(exception: HTTPException) -> tuple[Response, int]:
-    return jsonify({
+    # Only server errors are worth a traceback, client errors are expected.
+    # Unhandled exceptions come wrapped in InternalServerError
+    # and are already logged by Flask, so only explicit aborts are logged here.
+    if (
+            exception.code is not None
+            and exception.code >= HTTPStatus.INTERNAL_SERVER_ERROR
+            and getattr(exception, "original_exception", None) is None
+    ):
+        logging.exception("Server error %s occurred:", exception.code)
+    return json_response({
         "error": exception.description
     }), exception.code
@@ -0,0 +1,14 @@
+from typing import Any
+
+import orjson
+from flask import Response
+
+
+def json_response(payload: Any) -> Response:
+    """
+    Same as flask.jsonify, but serializes the payload with orjson,
+    which encodes straight to bytes.
+    :param payload: json-serializable object
+    :return: json Response
+    """
+    return Response(orjson.dumps(payload), mimetype="application/json")
@@ -1,18 +1,72 @@
 import base64
+import io
 import logging
-from contextlib import suppress
-from typing import Any
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
 from http import HTTPStatus
-from urllib.parse import urljoin
-from xml.dom import minidom
+from xml.sax.saxutils import XMLGenerator
 
+import orjson
 import requests
 from flask import current_app
-from tenacity import Retrying, stop_after_attempt, wait_exponential, retry_if_exception_type
-
-
-EXPORT_URL_TEMPLATE = "/v1/queues/{queue_id}/export?id={annotation_id}"
-RETRY_ATTEMPTS = 2
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    RetryCallState,
+    Retrying,
+    stop_after_attempt,
+    wait_exponential,
+    wait_random,
+    retry_if_exception_type,
+)
+
+
+RETRY_ATTEMPTS = 3
+RETRY_MAX_WAIT = 10
+# (connect, read) timeouts in seconds, applied to every attempt
+REQUEST_TIMEOUT = (3, 10)
+TRANSIENT_STATUS_CODES = frozenset({
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+})
+CONNECTION_POOL_SIZE = 10
+BATCH_MAX_WORKERS = 5
+UPLOAD_MAX_WORKERS = 5
+# Uploads queued or in progress at once, each one holds its base64 encoded XML in memory
+UPLOAD_MAX_PENDING = 50
+# Seconds an export waits for a free upload slot, before it drops its upload
+UPLOAD_SLOT_TIMEOUT = 1
+# (section schema_id, ((XML element name, datapoint schema_id), ...)), ...
+FLAT_ELEMENT_MAPPING = (
+    ("invoice_info_section", (
+        ("InvoiceNumber", "document_id"),
+        ("InvoiceDate", "date_issue"),
+        ("DueDate", "date_due"),
+    )),
+    ("payment_info_section", (
+        ("Iban", "iban"),
+    )),
+    ("amounts_section", (
+        ("TotalAmount", "amount_total"),
+        ("Amount", "amount_total_tax"),
+        ("Currency", "currency"),
+    )),
+    ("vendor_section", (
+        ("Vendor", "sender_name"),
+        ("VendorAddress", "sender_address"),
+    )),
+)
+FLAT_SECTION_IDS = frozenset(section_id for section_id, _ in FLAT_ELEMENT_MAPPING)
+# (line item datapoint schema_id, XML element name), ...
+DETAIL_ELEMENT_MAPPING = (
+    ("item_amount_total", "Amount"),
+    ("item_quantity", "Quantity"),
+    ("item_description", "Notes"),
+)
 
 
 class ExporterException(IOError):
@@ -22,6 +76,52 @@ class ExporterException(IOError):
     pass
 
 
+class TransientError(requests.exceptions.RequestException):
+    """
+    Raised on responses, which may succeed if the request is repeated later,
+    e.g. rate limiting or a temporarily unavailable upstream.
+    """
+    pass
+
+
+@dataclass
+class AnnotationIndex:
+    """
+    Values of an annotation, which are needed for the export, indexed by schema_id.
+    """
+    __slots__ = ("flat_values", "line_items_values")
+    # section schema_id -> datapoint schema_id -> value
+    flat_values: dict[str, dict[str, str]]
+    # datapoint schema_id -> value, one dict per line item
+    line_items_values: list[dict[str, str]]
+
+
+def _create_session() -> requests.Session:
+    """
+    Creates a session, which keeps connections alive between requests,
+    so that TCP and TLS handshakes are not repeated for every export.
+    Retries are handled by tenacity, thus the adapter doesn't retry.
+    :return: requests.Session with pooled connections
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=CONNECTION_POOL_SIZE,
+        pool_maxsize=CONNECTION_POOL_SIZE,
+        max_retries=0,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _create_session()
+# Uploads of results are not awaited by the export request, see _send_xml_result_to_rossum
+_upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="result-upload"
+)
+_upload_slots = threading.BoundedSemaphore(UPLOAD_MAX_PENDING)
+
+
 def send_annotation_info(queue_id: int, annotation_id: int) -> tuple[bool, str]:
     """
     Goes through the whole process of annotation processing:
@@ -57,6 +157,30 @@ def send_annotation_info(queue_id: int, annotation_id: int) -> tuple[bool, str]:
         return False, str(e)
 
 
+def send_annotations_info(exports: list[tuple[int, int]]) -> list[tuple[bool, str]]:
+    """
+    Processes several annotations concurrently, see send_annotation_info.
+    At most BATCH_MAX_WORKERS exports are in flight at once,
+    each worker picks up the next export as soon as it finishes one.
+
+    :param exports: list of (queue_id, annotation_id) tuples
+    :return: list of (success, error message) tuples, in the order of exports
+    """
+    app = current_app._get_current_object()
+
+    def send_in_app_context(export: tuple[int, int]) -> tuple[bool, str]:
+        # A failure of one export must not discard results of the others
+        try:
+            with app.app_context():
+                return send_annotation_info(*export)
+        except Exception:
+            logging.exception("Some exception happened during batch export of %s:", export)
+            return False, "Internal error"
+
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+        return list(executor.map(send_in_app_context, exports))
+
+
 def _get_annotation_json(queue_id: int, annotation_id: int) -> dict[str, Any]:
     """
     Downloads an annotation in JSON format from ROSSUM web.
@@ -64,184 +188,226 @@ def _get_annotation_json(queue_id: int, annotation_id: int) -> dict[str, Any]:
     :param annotation_id: int
     :return: dict, parsed annotation json
     """
+    url = f"{current_app.config['ROSSUM_QUEUES_URL']}{queue_id}/export?id={annotation_id}"
+    headers = {"Authorization": current_app.config["ROSSUM_AUTH_HEADER"]}
     try:
         for attempt in Retrying(
-            retry=retry_if_exception_type(requests.exceptions.RequestException),
+            retry=retry_if_exception_type((
+                TransientError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            )),
             stop=stop_after_attempt(RETRY_ATTEMPTS),
-            wait=wait_exponential(multiplier=1),
+            wait=_wait_before_retry,
             reraise=True,
         ):
             with attempt:
-                response = requests.get(
-                    urljoin(
-                        current_app.config["BASE_ROSSUM_URL"],
-                        EXPORT_URL_TEMPLATE.format(queue_id=queue_id, annotation_id=annotation_id)
-                    ),
-                    headers={"Authorization": f"token {current_app.config['ROSSUM_TOKEN']}"},
-                )
-                if response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
-                    raise requests.exceptions.RequestException
+                response = _session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+                if response.status_code in TRANSIENT_STATUS_CODES:
+                    raise TransientError(response=response)
+                elif response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+                    raise ExporterException("Internal error")
                 elif response.status_code >= HTTPStatus.BAD_REQUEST:
-                    raise ExporterException(response.json().get("detail", "Something wrong"))
-                return response.json()
+                    raise ExporterException(
+                        orjson.loads(response.content).get("detail", "Something wrong")
+                    )
+                return orjson.loads(response.content)
     except requests.exceptions.RequestException:
         raise ExporterException("Internal error")
 
 
+# Jitter keeps concurrently failing requests from retrying in lockstep
+_backoff = wait_exponential(multiplier=0.5, max=RETRY_MAX_WAIT) + wait_random(0, 1)
+
+
+def _wait_before_retry(retry_state: RetryCallState) -> float:
+    """
+    Computes how long to wait before the next attempt: the exponential backoff,
+    or longer if the server asked for it in a Retry-After header.
+    :param retry_state: state of the tenacity retrying
+    :return: float, seconds to wait
+    """
+    backoff = _backoff(retry_state)
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, TransientError):
+        retry_after = _get_retry_after(exception.response)
+        if retry_after is not None:
+            return max(backoff, min(retry_after, RETRY_MAX_WAIT))
+    return backoff
+
+
+def _get_retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Parses Retry-After header of a response, when it is given in seconds.
+    :param response: response to parse the header from
+    :return: float, seconds to wait, or None if the header is missing or is a date
+    """
+    with suppress(KeyError, ValueError):
+        return float(response.headers["Retry-After"])
+    return None
+
+
 def _convert_annotation_to_xml(annotation: dict[str, Any]) -> bytes:
     """
-    Convert a JSON annotation to a correct XML format
+    Convert a JSON annotation to a correct XML format.
+    XML is written out element by element, without building a tree in memory.
     :param annotation: dict, parsed json annotation
     :return: bytes, bytestring of a converted XML
     """
-    root = minidom.Document()
-    invoice_registers = root.createElement("InvoiceRegisters")
-    root.appendChild(invoice_registers)
-
-    invoices = root.createElement("Invoices")
-    invoice_registers.appendChild(invoices)
-
-    payable = root.createElement("Payable")
-    invoices.appendChild(payable)
-
-    sections = annotation.get("content", [])
-
-    # Flat is everything that is not details
-    flat_elements = _get_flat_elements_list(sections, root)
-    for element in flat_elements:
-        payable.appendChild(element)
-
-    details = root.createElement("Details")
-    payable.appendChild(details)
-    detail_elements = _get_detail_elements_list(sections, root)
-    for element in detail_elements:
-        details.appendChild(element)
-
-    return root.toprettyxml(encoding="utf-8")
-
-
-def _get_flat_elements_list(
-        sections: list[dict[str, Any]],
-        root: minidom.Document,
-) -> list[minidom.Element]:
-    """
-    Returns a list of XML elements, which are not <Details>.
-    :param sections: list of dicts, which contain info about the flat elements
-    :param root: root xml element
-    :return: list of XML elements
-    """
-    flat_element_mapping = {
-        "invoice_info_section": (
-            ("InvoiceNumber", "document_id"),
-            ("InvoiceDate", "date_issue"),
-            ("DueDate", "date_due"),
-        ),
-        "payment_info_section": (
-            ("Iban", "iban"),
-        ),
-        "amounts_section": (
-            ("TotalAmount", "amount_total"),
-            ("Amount", "amount_total_tax"),
-            ("Currency", "currency"),
-        ),
-        "vendor_section": (
-            ("Vendor", "sender_name"),
-            ("VendorAddress", "sender_address"),
-        )
-    }
-    result = []
-    for section_to_search_name, elements_to_append in flat_element_mapping.items():
-        section_to_search = _get_section_children(sections, section_to_search_name)
-        result.extend([
-            _create_text_element(element_name, invoice_info_key, root, section_to_search)
-            for element_name, invoice_info_key in elements_to_append
-        ])
-    result.append(root.createElement("Notes"))
-    return result
-
-
-def _get_detail_elements_list(
-        sections: list[dict[str, Any]],
-        root: minidom.Document
-) -> list[minidom.Element]:
-    """
-    Returns a list of XML elements, which live in <Detail>
-    :param sections: list of dicts, which contain info about the detail elements
-    :param root: root xml element
-    :return: list of XML elements
-    """
-    detail_element_mapping = {
-        "item_amount_total": "Amount",
-        "item_quantity": "Quantity",
-        "item_description": "Notes",
-    }
-    details = _get_section_children(
-        _get_section_children(sections, "line_items_section"),
-        "line_items"
-    )
-    result = []
-    for detail in details:
-        detail_element = root.createElement("Detail")
-        for json_key, element_name in detail_element_mapping.items():
-            detail_element.appendChild(
-                _create_text_element(
-                    element_name, json_key, root, detail.get("children", [])
-                )
+    output = io.BytesIO()
+    writer = XMLGenerator(output, encoding="utf-8", short_empty_elements=True)
+    annotation_index = _index_annotation(annotation)
+
+    writer.startDocument()
+    with _write_element(writer, "InvoiceRegisters"):
+        with _write_element(writer, "Invoices"):
+            with _write_element(writer, "Payable"):
+                # Flat is everything that is not details
+                _write_flat_elements(writer, annotation_index.flat_values)
+                with _write_element(writer, "Details"):
+                    _write_detail_elements(writer, annotation_index.line_items_values)
+    writer.endDocument()
+
+    return output.getvalue()
+
+
+def _write_flat_elements(
+        writer: XMLGenerator,
+        flat_values: dict[str, dict[str, str]]
+) -> None:
+    """
+    Writes XML elements, which are not <Details>.
+    :param writer: XML writer to write elements to
+    :param flat_values: dict, values of flat sections, see AnnotationIndex
+    """
+    for section_to_search_name, elements_to_write in FLAT_ELEMENT_MAPPING:
+        section_values = flat_values.get(section_to_search_name, {})
+        for element_name, invoice_info_key in elements_to_write:
+            _write_text_element(
+                writer, element_name, section_values.get(invoice_info_key, "")
             )
-        detail_element.appendChild(root.createElement("AccountId"))
-        result.append(detail_element)
-    return result
+    _write_text_element(writer, "Notes", "")
 
 
-def _get_section_children(
-        sections: list[dict[str, Any]],
-        section_name: str
-) -> list[dict[str, str]]:
+def _write_detail_elements(
+        writer: XMLGenerator,
+        line_items_values: list[dict[str, str]]
+) -> None:
     """
-    Fetches children of a specific section from a list of sections.
-    :param sections: list of sections
-    :param section_name: name of a sections from which to fetch children
-    :return: list of dicts - children
+    Writes <Detail> XML elements, one per line item.
+    :param writer: XML writer to write elements to
+    :param line_items_values: list of dicts, values of line items, see AnnotationIndex
     """
-    for section in sections:
-        if section.get("schema_id") == section_name:
-            return section.get("children", [])
-    return []
+    for detail_values in line_items_values:
+        with _write_element(writer, "Detail"):
+            for json_key, element_name in DETAIL_ELEMENT_MAPPING:
+                _write_text_element(writer, element_name, detail_values.get(json_key, ""))
+            _write_text_element(writer, "AccountId", "")
 
 
-def _create_text_element(
-        element_name: str,
-        json_key: str,
-        root: minidom.Document,
-        children: list[dict[str, str]]
-) -> minidom.Element:
-    element = root.createElement(element_name)
-    text = root.createTextNode(_find_value_in_children(children, json_key))
-    element.appendChild(text)
-    return element
+def _index_annotation(annotation: dict[str, Any]) -> AnnotationIndex:
+    """
+    Indexes values of an annotation in a single pass over its sections.
+    Only the flat sections and line items are visited, the rest is skipped.
+    If a schema_id is repeated, the first occurrence is used.
+    :param annotation: dict, parsed json annotation
+    :return: AnnotationIndex
+    """
+    flat_values = {}
+    line_items_values = None
+    for section in annotation.get("content", []):
+        section_id = section.get("schema_id")
+        if section_id in FLAT_SECTION_IDS and section_id not in flat_values:
+            flat_values[section_id] = _get_values_by_schema_id(section.get("children", []))
+        elif section_id == "line_items_section" and line_items_values is None:
+            line_items_values = _get_line_items_values(section.get("children", []))
+    return AnnotationIndex(flat_values, line_items_values or [])
+
+
+def _get_line_items_values(children: list[dict[str, Any]]) -> list[dict[str, str]]:
+    """
+    Indexes values of every line item from the first "line_items" child.
+    :param children: list of children of the line items section
+    :return: list of dicts, child schema_id -> value, one per line item
+    """
+    for child in children:
+        if child.get("schema_id") == "line_items":
+            return [
+                _get_values_by_schema_id(line_item.get("children", []))
+                for line_item in child.get("children", [])
+            ]
+    return []
 
 
-def _find_value_in_children(children: list[dict[str, str]], child_name: str) -> str:
+def _get_values_by_schema_id(children: list[dict[str, Any]]) -> dict[str, str]:
+    """
+    Indexes values of children by their schema_id, the first occurrence wins.
+    :param children: list of children
+    :return: dict, child schema_id -> value of the child
+    """
+    values = {}
     for child in children:
-        if child.get("schema_id") == child_name:
-            return child.get("value", "")
-    return ""
+        values.setdefault(child.get("schema_id"), child.get("value") or "")
+    return values
+
+
+@contextmanager
+def _write_element(writer: XMLGenerator, element_name: str) -> Iterator[None]:
+    """
+    Writes the opening tag of an element on enter and the closing one on exit.
+    """
+    writer.startElement(element_name, {})
+    yield
+    writer.endElement(element_name)
+
+
+def _write_text_element(writer: XMLGenerator, element_name: str, value: str) -> None:
+    writer.startElement(element_name, {})
+    # Empty elements are written as self-closing tags, without a text node
+    if value:
+        writer.characters(value)
+    writer.endElement(element_name)
 
 
-def _send_xml_result_to_rossum(annotation_id: int, xml_result: bytes) -> None:
+def _send_xml_result_to_rossum(annotation_id: int, xml_result: bytes) -> Optional[Future]:
     """
     This function will have no retrying or any other safe guards,
     since it sends a request to a known non-working endpoint.
+    For the same reason the request is sent in the background,
+    so that the export doesn't wait for a response nobody looks at.
+
+    At most UPLOAD_MAX_PENDING uploads are queued or running at once.
+    When all of them are taken for longer than UPLOAD_SLOT_TIMEOUT,
+    e.g. because the endpoint hangs, the upload is dropped instead of blocking the export.
+    Each upload is limited by REQUEST_TIMEOUT. Pending uploads are still sent
+    when the process exits, so they may delay its shutdown by up to that long.
 
     :param annotation_id: int, id of an annotation to be sent
     :param xml_result: bytes, resulted xml bytestring
+    :return: Future of the upload, None if the upload was dropped
     """
-    xml_encoded = base64.encodebytes(xml_result)
-    with suppress(Exception):
-        requests.post(
+    xml_encoded = base64.b64encode(xml_result)
+    if not _upload_slots.acquire(timeout=UPLOAD_SLOT_TIMEOUT):
+        logging.warning(
+            "Too many pending uploads, result of annotation %s is not sent.", annotation_id
+        )
+        return None
+    try:
+        future = _upload_executor.submit(
+            _post_ignoring_errors,
             current_app.config["RESULT_ROSSUM_URL"],
-            data={
+            {
                 "annotationId": annotation_id,
                 "content": xml_encoded
             }
         )
+    except Exception:
+        _upload_slots.release()
+        raise
+    future.add_done_callback(lambda _: _upload_slots.release())
+    return future
+
+
+def _post_ignoring_errors(url: str, data: dict[str, Any]) -> None:
+    with suppress(Exception):
+        _session.post(url, data=data, timeout=REQUEST_TIMEOUT)
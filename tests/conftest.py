@@ -1,4 +1,4 @@
-from dataclasses import fields
+from concurrent.futures import Executor, Future
 import os
 from typing import Callable, Protocol
 from unittest import mock
@@ -6,6 +6,7 @@ from unittest import mock
 from flask.testing import FlaskClient
 import pytest
 
+from exporter import create_app, services
 from exporter.config import Config
 
 
@@ -17,10 +18,33 @@ class ClientMaker(Protocol):
 @pytest.fixture
 def get_test_client() -> Callable:
     def client_maker(env_dict: dict[str, str]) -> FlaskClient:
-        for field in fields(Config):
-            env_dict.setdefault(field.name, "")
+        for field in Config._fields:
+            env_dict.setdefault(field, "")
         with mock.patch.dict(os.environ, env_dict):
-            from app import app
-            app.testing = True
-            return app.test_client()
+            app = create_app(Config.from_env())
+        app.testing = True
+        return app.test_client()
     return client_maker
+
+
+class InlineExecutor(Executor):
+    """
+    Runs submitted calls right away in the calling thread.
+    """
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+@pytest.fixture(autouse=True)
+def upload_inline():
+    """
+    Makes background uploads of results synchronous,
+    so that they are done while requests are mocked.
+    """
+    with mock.patch.object(services, "_upload_executor", InlineExecutor()):
+        yield
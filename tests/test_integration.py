@@ -1,8 +1,9 @@
-import json
 from unittest import mock
 
-import requests
+import pytest
 
+from exporter.controllers import MAX_BATCH_SIZE
+from exporter.services import _session
 from tests.conftest import ClientMaker
 
 CORRECT_USERNAME = "test"
@@ -15,16 +16,145 @@ def test_full_run_ok(get_test_client: ClientMaker):
         "CORRECT_PASSWORD": CORRECT_PASSWORD
     })
 
-    get_patch = mock.patch.object(requests, "get")
-    post_patch = mock.patch.object(requests, "post")
-    with get_patch as get_mock, post_patch:
+    get_patch = mock.patch.object(_session, "get")
+    post_patch = mock.patch.object(_session, "post")
+    with get_patch as get_mock, post_patch as post_mock:
         get_mock.return_value.status_code = 200
-        with open("tests/fake_data.json") as fake_data:
-            get_mock.return_value.json = mock.Mock()
-            get_mock.return_value.json.return_value = json.loads(fake_data.read())
+        with open("tests/fake_data.json", "rb") as fake_data:
+            get_mock.return_value.content = fake_data.read()
         response = client.post(
             "/export",
             auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
             json={"annotation_id": 1, "queue_id": 1}
         )
         assert response.json == {"success": True}
+        post_mock.assert_called_once()
+
+
+@pytest.mark.parametrize("body", [
+    [{"annotation_id": 1, "queue_id": 1}],
+    [["annotation_id", 1], ["queue_id", 1]],
+])
+def test_export_body_not_an_object(get_test_client: ClientMaker, body: list):
+    client = get_test_client(env_dict={
+        "CORRECT_USERNAME": CORRECT_USERNAME,
+        "CORRECT_PASSWORD": CORRECT_PASSWORD
+    })
+
+    with mock.patch.object(_session, "get") as get_mock:
+        response = client.post(
+            "/export",
+            auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+            json=body
+        )
+    assert response.status_code == 400
+    assert response.json[0]["type"] == "type_error.dict"
+    get_mock.assert_not_called()
+
+
+def test_batch_run_ok(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={
+        "CORRECT_USERNAME": CORRECT_USERNAME,
+        "CORRECT_PASSWORD": CORRECT_PASSWORD
+    })
+
+    get_patch = mock.patch.object(_session, "get")
+    post_patch = mock.patch.object(_session, "post")
+    with get_patch as get_mock, post_patch as post_mock:
+        get_mock.return_value.status_code = 200
+        with open("tests/fake_data.json", "rb") as fake_data:
+            get_mock.return_value.content = fake_data.read()
+        response = client.post(
+            "/export/batch",
+            auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+            json=[{"annotation_id": 1, "queue_id": 1}, {"annotation_id": 2, "queue_id": 1}]
+        )
+        assert response.json == [
+            {"annotation_id": 1, "success": True},
+            {"annotation_id": 2, "success": True},
+        ]
+        assert post_mock.call_count == 2
+
+
+def test_client_error_not_logged(get_test_client: ClientMaker, caplog):
+    client = get_test_client(env_dict={})
+
+    response = client.post("/export", json={"annotation_id": 1, "queue_id": 1})
+
+    assert response.status_code == 401
+    assert not caplog.records
+
+
+def test_explicit_server_error_logged(get_test_client: ClientMaker, caplog):
+    client = get_test_client(env_dict={})
+
+    with mock.patch.dict(client.application.config, {"CORRECT_CREDENTIALS_DIGESTS": None}):
+        response = client.post(
+            "/export",
+            auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+            json={"annotation_id": 1, "queue_id": 1}
+        )
+
+    assert response.status_code == 500
+    assert [record.getMessage() for record in caplog.records] == ["Server error 500 occurred:"]
+
+
+def test_unhandled_error_logged_once(get_test_client: ClientMaker, caplog):
+    client = get_test_client(env_dict={})
+
+    testing_patch = mock.patch.dict(client.application.config, {"TESTING": False})
+    auth_patch = mock.patch("exporter.auth._credentials_are_correct", return_value=True)
+    send_patch = mock.patch(
+        "exporter.controllers.send_annotation_info", side_effect=RuntimeError
+    )
+    with testing_patch, auth_patch, send_patch:
+        response = client.post(
+            "/export",
+            auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+            json={"annotation_id": 1, "queue_id": 1}
+        )
+
+    assert response.status_code == 500
+    # Logged by Flask itself, not by the handler of HTTP exceptions again
+    assert [record.getMessage() for record in caplog.records] == ["Exception on /export [POST]"]
+
+
+def test_batch_failed_item_does_not_fail_others(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={
+        "CORRECT_USERNAME": CORRECT_USERNAME,
+        "CORRECT_PASSWORD": CORRECT_PASSWORD
+    })
+    with open("tests/fake_data.json", "rb") as fake_data:
+        content = fake_data.read()
+
+    def get_annotation(url: str, **kwargs) -> mock.Mock:
+        response = mock.Mock(status_code=200)
+        # Annotation 1 responds with a body, which is not json
+        response.content = b"<html></html>" if url.endswith("id=1") else content
+        return response
+
+    with mock.patch.object(_session, "get", side_effect=get_annotation), \
+            mock.patch.object(_session, "post"):
+        response = client.post(
+            "/export/batch",
+            auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+            json=[{"annotation_id": 1, "queue_id": 1}, {"annotation_id": 2, "queue_id": 1}]
+        )
+    assert response.json == [
+        {"annotation_id": 1, "success": False, "error_message": "Internal error"},
+        {"annotation_id": 2, "success": True},
+    ]
+
+
+def test_batch_too_large(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={
+        "CORRECT_USERNAME": CORRECT_USERNAME,
+        "CORRECT_PASSWORD": CORRECT_PASSWORD
+    })
+
+    response = client.post(
+        "/export/batch",
+        auth=(CORRECT_USERNAME, CORRECT_PASSWORD),
+        json=[{"annotation_id": 1, "queue_id": 1}] * (MAX_BATCH_SIZE + 1)
+    )
+    assert response.status_code == 400
@@ -1,3 +1,142 @@
-"""
-Not required by the task
-"""
+import threading
+from unittest import mock
+from xml.etree import ElementTree
+
+import orjson
+import pytest
+
+from exporter import services
+from exporter.services import (
+    REQUEST_TIMEOUT,
+    RETRY_ATTEMPTS,
+    ExporterException,
+    _convert_annotation_to_xml,
+    _get_annotation_json,
+    _send_xml_result_to_rossum,
+    _session,
+)
+from tests.conftest import ClientMaker
+
+
+def test_annotation_not_found_is_not_retried(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={})
+
+    with mock.patch.object(_session, "get") as get_mock, client.application.app_context():
+        get_mock.return_value.status_code = 404
+        get_mock.return_value.content = b'{"detail": "Not found."}'
+        with pytest.raises(ExporterException, match="Not found."):
+            _get_annotation_json(1, 1)
+
+    assert get_mock.call_count == 1
+
+
+def test_server_error_is_not_retried(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={})
+
+    with mock.patch.object(_session, "get") as get_mock, client.application.app_context():
+        get_mock.return_value.status_code = 500
+        with pytest.raises(ExporterException, match="Internal error"):
+            _get_annotation_json(1, 1)
+
+    assert get_mock.call_count == 1
+
+
+def test_unavailable_is_retried_after_requested_time(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={})
+
+    with mock.patch.object(_session, "get") as get_mock, client.application.app_context():
+        get_mock.return_value.status_code = 503
+        get_mock.return_value.headers = {"Retry-After": "5"}
+        with mock.patch("time.sleep") as sleep_mock, pytest.raises(ExporterException):
+            _get_annotation_json(1, 1)
+
+    assert get_mock.call_count == RETRY_ATTEMPTS
+    # Retry-After is longer than the backoff of the first attempts, so it is waited instead
+    assert sleep_mock.call_args_list == [mock.call(5)] * (RETRY_ATTEMPTS - 1)
+
+
+def test_annotation_converted_to_xml():
+    with open("tests/fake_data.json", "rb") as fake_data:
+        annotation = orjson.loads(fake_data.read())["results"][0]
+
+    root = ElementTree.fromstring(_convert_annotation_to_xml(annotation))
+
+    assert root.tag == "InvoiceRegisters"
+    payable = root.find("Invoices/Payable")
+    assert [(element.tag, element.text or "") for element in payable][:-1] == [
+        ("InvoiceNumber", "143453775"),
+        ("InvoiceDate", ""),
+        ("DueDate", "2019-03-31"),
+        ("Iban", "NO6513425245230"),
+        ("TotalAmount", "12978.81"),
+        ("Amount", "2595.76"),
+        ("Currency", "nok"),
+        ("Vendor", "InfoNet Workshop"),
+        ("VendorAddress", ""),
+        ("Notes", ""),
+    ]
+    assert payable[-1].tag == "Details"
+
+    details = payable.findall("Details/Detail")
+    assert len(details) == 3
+    for detail in details:
+        assert [element.tag for element in detail] == ["Amount", "Quantity", "Notes", "AccountId"]
+        assert detail.findtext("Amount") == ""
+        assert detail.findtext("AccountId") == ""
+    assert [detail.findtext("Quantity") for detail in details] == ["3", "4", "1"]
+    assert details[0].findtext("Notes").startswith("HPI Battery 4C 40WHr")
+
+
+def test_result_uploaded_with_timeout(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={"RESULT_ROSSUM_URL": "https://result.test"})
+
+    with mock.patch.object(_session, "post") as post_mock, client.application.app_context():
+        _send_xml_result_to_rossum(1, b"<xml/>")
+
+    post_mock.assert_called_once_with(
+        "https://result.test",
+        data={"annotationId": 1, "content": b"PHhtbC8+"},
+        timeout=REQUEST_TIMEOUT,
+    )
+
+
+def test_result_dropped_when_uploads_are_stuck(get_test_client: ClientMaker):
+    client = get_test_client(env_dict={})
+
+    # No free slots, as if all uploads hang
+    slots_patch = mock.patch.object(services, "_upload_slots", threading.Semaphore(0))
+    timeout_patch = mock.patch.object(services, "UPLOAD_SLOT_TIMEOUT", 0)
+    with slots_patch, timeout_patch, mock.patch.object(_session, "post") as post_mock, \
+            client.application.app_context():
+        assert _send_xml_result_to_rossum(1, b"<xml/>") is None
+
+    post_mock.assert_not_called()
+
+
+def test_first_of_repeated_schema_ids_converted():
+    def line_items_section(quantity: str) -> dict:
+        return {"schema_id": "line_items_section", "children": [
+            {"schema_id": "line_items", "children": [
+                {"schema_id": "line_item", "children": [
+                    {"schema_id": "item_quantity", "value": quantity},
+                ]},
+            ]},
+        ]}
+
+    annotation = {"content": [
+        {"schema_id": "invoice_info_section", "children": [
+            {"schema_id": "document_id", "value": "first"},
+            {"schema_id": "document_id", "value": "second"},
+        ]},
+        {"schema_id": "invoice_info_section", "children": [
+            {"schema_id": "document_id", "value": "third"},
+        ]},
+        line_items_section("1"),
+        line_items_section("2"),
+    ]}
+
+    root = ElementTree.fromstring(_convert_annotation_to_xml(annotation))
+
+    assert root.findtext("Invoices/Payable/InvoiceNumber") == "first"
+    quantities = root.findall("Invoices/Payable/Details/Detail/Quantity")
+    assert [quantity.text for quantity in quantities] == ["1"]